@@ -1,9 +1,27 @@
+import ast
+import math
+import operator
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from ddgs import DDGS
+from ddgs.exceptions import DDGSException, TimeoutException
 import json
 import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import lru_cache
 from flask import Flask, jsonify, request, render_template, send_file
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 WIKIPEDIA_API_HEADERS = {
     "User-Agent": "nilch/1.0 (jake.stbu@gmail.com)"
@@ -13,135 +31,401 @@ DDG_API_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"
 }
 
+# Seconds to wait on Wiktionary/Wikipedia before giving up on the infobox
+REQUEST_TIMEOUT = 5
+
+# One keep-alive session for Wiktionary/Wikipedia, so repeat lookups skip the TCP/TLS handshake
+wiki_session = requests.Session()
+wiki_session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=Retry(total=1, status_forcelist=[502, 503, 504], respect_retry_after_header=False)))
+# (connect, read) seconds per attempt, so both attempts together fit inside REQUEST_TIMEOUT
+WIKI_ATTEMPT_TIMEOUT = (1, REQUEST_TIMEOUT / 2 - 1)
+
+# Shared pool for the infobox lookups so they can run alongside each other
+INFOBOX_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+# Dictionary and encyclopedia entries barely change, so their infoboxes are kept for an hour
+INFOBOX_TTL = 3600
+INFOBOX_CACHE_MAX = 2000
+# (infotype, word or title) -> (expiry time, infobox)
+infobox_cache = {}
+infobox_cache_lock = threading.Lock()
+
+# uWSGI (which PythonAnywhere runs) doesn't run threads the app starts unless enable-threads or
+# threads is set, and a fire-and-forget prefetch would never happen there
+def _threads_enabled():
+    try:
+        import uwsgi
+    except ImportError:
+        return True
+    return bool(uwsgi.opt.get("enable-threads") or uwsgi.opt.get("threads"))
+
+THREADS_ENABLED = _threads_enabled()
+
+# Pages past this one are never prefetched
+PREFETCH_MAX_PAGE = 10
+# At most this many next-page prefetches may be waiting on upstream at once
+prefetch_slots = threading.BoundedSemaphore(4)
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# Compiled once at import rather than on every search
+DIGITS = frozenset("0123456789")
+MATHS_PATTERN = re.compile(r'^(?:(?:what is|solve|calculate|calc) )?(?P<expr>[+\-/*÷x()0-9.^ ]+?)=?$', re.IGNORECASE)
+MATHS_OPERATORS = str.maketrans({"x": "*", "X": "*", "÷": "/"})
+SAFE_EXPR_PATTERN = re.compile(r'^[0-9+\-/*().\s]+$')
+# Powers are the one operation that can blow up, so cap how big they can get
+MATHS_MAX_EXPONENT = 1000
+MATHS_MAX_DIGITS = 4300
+
+def _safe_pow(base, exponent):
+    if (abs(exponent) > MATHS_MAX_EXPONENT
+            or (abs(base) > 1 and math.log10(abs(base)) * abs(exponent) > MATHS_MAX_DIGITS)):
+        raise ValueError("power too large")
+    return operator.pow(base, exponent)
+
+# The only operations a calc infobox is allowed to perform
+MATHS_BINARY_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Pow: _safe_pow,
+}
+MATHS_UNARY_OPS = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+DEFINITION_PATTERN = re.compile(r'^(?:what does ([a-zA-Z]+) mean|define ([a-zA-Z]+))$', re.IGNORECASE)
+# Pulls the (already URL-encoded) article title straight out of an English Wikipedia link,
+# the only one the summary API is asked about
+WIKIPEDIA_URL_PATTERN = re.compile(r'^https?://en(?:\.m)?\.wikipedia\.org/wiki/([^?#\s]+)')
+
 models = ["bing", "brave", "google", "mojeek", "yahoo"]
 
-recent_searches = []
+# Seconds to leave a backend alone after a request to it fails
+BACKEND_COOLDOWN = 60
+# Backend -> time it can be used again
+backend_cooldowns = {}
+backend_cooldowns_lock = threading.Lock()
+
+# ddgs wraps errors from its HTTP client as "<ErrorType>: <repr>", and turns any non-200 page
+# (a 429 included) into a plain "No results found.", so rate limits can't be told apart from
+# empty results
+DDGS_TRANSPORT_ERROR_PATTERN = re.compile(r'^\w+(?:Error|Exception): ')
+
+# True if the search failed because the backend couldn't be reached, rather than because of the query
+def backend_failed(ex: Exception):
+    return isinstance(ex, TimeoutException) or (isinstance(ex, DDGSException) and bool(DDGS_TRANSPORT_ERROR_PATTERN.match(str(ex))))
+
+# Returns the requested backend, or the next one in models that isn't cooling down
+def pick_backend(backend: str):
+    now = time.time()
+    with backend_cooldowns_lock:
+        if (backend_cooldowns.get(backend, 0) <= now):
+            return backend
+        start = models.index(backend) + 1 if backend in models else 0
+        for i in range(len(models)):
+            model = models[(start + i) % len(models)]
+            if (backend_cooldowns.get(model, 0) <= now):
+                return model
+    return backend
+
+# DDGS keeps its engines and their HTTP clients per instance, so idle clients are pooled and reused.
+# Flask's server starts a new thread per request, so they can't simply be kept per thread
+ddgs_pool = []
+ddgs_pool_lock = threading.Lock()
+
+# Lends out a DDGS client, which no other thread uses until it's handed back
+@contextmanager
+def ddgs_client():
+    with ddgs_pool_lock:
+        client = ddgs_pool.pop() if ddgs_pool else DDGS()
+    try:
+        yield client
+    finally:
+        with ddgs_pool_lock:
+            ddgs_pool.append(client)
+
+# Results per page from DDGS's video engine, where the text engines give ten
+VIDEOS_PER_UPSTREAM_PAGE = 60
+RECENT_VIDEO_BLOCKS_MAX = 10
+# (query, safe, block) -> that block's videos, the least recently used is dropped first
+recent_video_blocks = OrderedDict()
+recent_video_blocks_lock = threading.Lock()
+
+# Returns the given block of VIDEOS_PER_UPSTREAM_PAGE videos, fetched once for all the pages in it
+def get_video_block(query: str, safe_search: str, block: int):
+    key = (query, safe_search, block)
+    with recent_video_blocks_lock:
+        if key in recent_video_blocks:
+            recent_video_blocks.move_to_end(key)
+            return recent_video_blocks[key]
+    with ddgs_client() as ddgs:
+        results = ddgs.videos(query=query, max_results=VIDEOS_PER_UPSTREAM_PAGE, page=block+1, backend="bing", safesearch=safe_search)
+    with recent_video_blocks_lock:
+        recent_video_blocks[key] = results
+        if (len(recent_video_blocks) > RECENT_VIDEO_BLOCKS_MAX):
+            recent_video_blocks.popitem(last=False)
+    return results
+
+# Searches kept in recent_searches, the least recently used is dropped first
+RECENT_SEARCHES_MAX = 20
+
+# (query, safe, is_videos, language, page, backend) -> results
+recent_searches = OrderedDict()
+# Flask serves requests on several threads, which all share recent_searches
+recent_searches_lock = threading.Lock()
+
+# Latest image searches, the least recently used is dropped first
+RECENT_IMAGES_MAX = 50
+recent_images = OrderedDict()
+recent_images_lock = threading.Lock()
 
 # Returns results
 def add_recent_search(query: str, safe_search: str, is_videos: str, page: int, language: str, backend: str, results):
-    recent_searches.append({
-        "query": query,
-        "safe": safe_search,
-        "is_videos": is_videos,
-        "page": page,
-        "language": language,
-        "backend": backend,
-        "results": results
-    })
-    if (len(recent_searches) >= 20):
-        recent_searches.pop(0)
+    key = (query, safe_search, is_videos, language, page, backend)
+    with recent_searches_lock:
+        recent_searches[key] = results
+        recent_searches.move_to_end(key)
+        if (len(recent_searches) > RECENT_SEARCHES_MAX):
+            recent_searches.popitem(last=False)
     return results
 
 # Returns None if not in cache, otherwise search results
 def check_for_recent_search(query: str, safe_search: str, is_videos: str, language: str, page: int, backend: str):
-    criteria = {
-        "query": query,
-        "safe": safe_search,
-        "is_videos": is_videos,
-        "language": language,
-        "page": page,
-        "backed": backend
-    }
-    for search in recent_searches:
-        match = all(
-            search.get(key) == value 
-            for key, value in criteria.items() 
-            if key != "results"
-        )
-        if match:
-            return search.get("results")
-    return None
+    key = (query, safe_search, is_videos, language, page, backend)
+    with recent_searches_lock:
+        results = recent_searches.get(key)
+        if (results != None):
+            # Refresh the hit, so repeated searches are the last to be evicted
+            recent_searches.move_to_end(key)
+    return results
 
 def get_web_results(query: str, safe_search: str, is_videos: str, page: int, language: str, backend: str):
     if safe_search == "strict":
         safe_search = "on"
     else:
         safe_search = "off"
+    # Results are cached under the backend that actually gave them, so a fallback's pages
+    # don't outlive its cooldown as the requested backend's
+    if (not is_videos):
+        backend = pick_backend(backend)
     recent = check_for_recent_search(query, safe_search, is_videos, language, page, backend)
     if (recent != None):
         return recent
     result_type = "videos" if is_videos else "web"
     try:
         if (is_videos):
-            results = DDGS().videos(query=query, max_results=10+int(page)*10, backend="bing", safesearch=safe_search)[int(page)*10:]
+            # The video engine pages in blocks of 60, so slice this page out of the block holding it
+            pages_per_block = VIDEOS_PER_UPSTREAM_PAGE // 10
+            block_start = (int(page) % pages_per_block) * 10
+            results = get_video_block(query, safe_search, int(page) // pages_per_block)[block_start:block_start+10]
             print(results)
-            return add_recent_search(query, safe_search, is_videos, page, "en-UK", "bing", results)
+            return add_recent_search(query, safe_search, is_videos, page, language, backend, results)
         else:
-            results = DDGS().text(query=query, max_results=10+int(page)*10, backend=backend, safesearch=safe_search, region=language)[int(page)*10:]
+            with ddgs_client() as ddgs:
+                results = ddgs.text(query=query, max_results=10, page=int(page)+1, backend=backend, safesearch=safe_search, region=language)
             return add_recent_search(query, safe_search, is_videos, page, language, backend, results)
-    except Exception:
+    except Exception as ex:
+        if (not is_videos and backend_failed(ex)):
+            with backend_cooldowns_lock:
+                backend_cooldowns[backend] = time.time() + BACKEND_COOLDOWN
         return []
     return None
 
+def _prefetch(query: str, safe_search: str, is_videos: str, page: int, language: str, backend: str):
+    try:
+        get_web_results(query, safe_search, is_videos, page, language, backend)
+    finally:
+        prefetch_slots.release()
+
+# People usually go on to the next page, so fetch it into the recent searches in the background
+def prefetch_next_page(query: str, safe_search: str, is_videos: str, page: int, language: str, backend: str, results):
+    # A short page is the last one, deep pages are rarely reached, and without threads nothing would run it
+    if (not THREADS_ENABLED or page + 1 > PREFETCH_MAX_PAGE or len(results) < 10):
+        return
+    # Drop the prefetch rather than queue it when enough are already in flight
+    if (not prefetch_slots.acquire(blocking=False)):
+        return
+    PREFETCH_EXECUTOR.submit(_prefetch, query, safe_search, is_videos, page + 1, language, backend)
+
 def get_img_results(query: str, safe_search: str):
     if safe_search == "strict":
         safe_search = "on"
     else:
         safe_search = "off"
-    results = DDGS().images(query=query, max_results=200, backend="bing", safesearch=safe_search)
+    key = (query, safe_search)
+    with recent_images_lock:
+        if key in recent_images:
+            recent_images.move_to_end(key)
+            return recent_images[key]
+    with ddgs_client() as ddgs:
+        results = ddgs.images(query=query, max_results=200, backend="bing", safesearch=safe_search)
+    with recent_images_lock:
+        recent_images[key] = results
+        if (len(recent_images) > RECENT_IMAGES_MAX):
+            recent_images.popitem(last=False)
     return results
 
-def get_infobox(web_results, query):
-    # Check if the user is trying to get a maths equation done
-    expr_pattern = r'[+\-/*÷x()0-9.^ ]+'
-    maths_patterns = [
-        rf'^what is ({expr_pattern})$',
-        rf'^solve ({expr_pattern})$',
-        rf'^calc ({expr_pattern})$',
-        rf'^calculate ({expr_pattern})$',
-        rf'^({expr_pattern})$',
-        rf'^({expr_pattern})=$',
-    ]
-    for pattern in maths_patterns:
-        match = re.match(pattern, query, re.IGNORECASE)
-        if match:
-            equ = match.group(1).strip()
-            equ = equ.replace("x", "*").replace("÷", "/").replace("^", "**")
+# Walks a parsed expression, raising on anything that isn't plain arithmetic
+def _eval_ast(node):
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in MATHS_BINARY_OPS:
+        return MATHS_BINARY_OPS[type(node.op)](_eval_ast(node.left), _eval_ast(node.right))
+    if isinstance(node, ast.UnaryOp) and type(node.op) in MATHS_UNARY_OPS:
+        return MATHS_UNARY_OPS[type(node.op)](_eval_ast(node.operand))
+    raise ValueError("unsupported expression")
+
+# Common sums like 2+2 get asked over and over, so keep their answers around
+@lru_cache(maxsize=256)
+def _eval_expr(equ: str):
+    return _eval_ast(ast.parse(equ, mode="eval").body)
+
+def _solve_math(query: str):
+    # Nothing without a digit can be a sum, which rules out most searches before any regex runs
+    if (len(query) > 100 or DIGITS.isdisjoint(query)):
+        return None
+    match = MATHS_PATTERN.match(query)
+    if (match == None):
+        return None
+    equ = match.group("expr").strip()
+    equ = equ.translate(MATHS_OPERATORS).replace("^", "**")
+    if (not SAFE_EXPR_PATTERN.match(equ)):
+        return None
+    try:
+        return {"infotype": "calc", "equ": equ, "result": str(_eval_expr(equ))}
+    except Exception:
+        return None
+
+def _get_definition(word: str):
+    url = "https://en.wiktionary.org/api/rest_v1/page/definition/" + word
+    response = wiki_session.get(url, headers=WIKIPEDIA_API_HEADERS, timeout=WIKI_ATTEMPT_TIMEOUT)
+    if response.status_code != 200:
+        return None
+    data = response.json()
+    definition = None
+    for d in data["en"][0]["definitions"]:
+        if d["definition"] != "":
+            definition = d["definition"]
+            break
+    return {"word": word,
+            "type": data["en"][0]["partOfSpeech"],
+            "definition": definition,
+            "url": "https://en.wiktionary.org/wiki/" + word,
+            "infotype": "definition"}
+
+def _get_wikipedia_summary(formatted_title: str):
+    url = "https://en.wikipedia.org/api/rest_v1/page/summary/" + formatted_title
+    response = wiki_session.get(url, headers=WIKIPEDIA_API_HEADERS, timeout=WIKI_ATTEMPT_TIMEOUT)
+    if response.status_code != 200:
+        return None
+    data = response.json()
+    return {"title": data["title"],
+            "info": data["extract"],
+            "url": data["content_urls"]["desktop"]["page"],
+            "infotype": "wikipedia"}
+
+# Returns the cached infobox for key, or None if there isn't a live one
+def _get_cached_infobox(key):
+    with infobox_cache_lock:
+        entry = infobox_cache.get(key)
+    if (entry != None and entry[0] > time.time()):
+        return entry[1]
+    return None
+
+def _fetch_infobox(key, fetcher, arg: str):
+    infobox = fetcher(arg)
+    if (infobox != None):
+        now = time.time()
+        with infobox_cache_lock:
+            if (len(infobox_cache) >= INFOBOX_CACHE_MAX):
+                for expired in [k for k, v in infobox_cache.items() if v[0] <= now]:
+                    del infobox_cache[expired]
+            # Still full of live entries, so drop the oldest
+            if (len(infobox_cache) >= INFOBOX_CACHE_MAX):
+                del infobox_cache[next(iter(infobox_cache))]
+            infobox_cache[key] = (now + INFOBOX_TTL, infobox)
+    return infobox
+
+# Returns a future for fetcher(arg). Cache hits are answered right away, only misses go to the pool
+def _infobox_lookup(key, fetcher, arg: str):
+    infobox = _get_cached_infobox(key)
+    if (infobox != None):
+        future = Future()
+        future.set_result(infobox)
+        return future
+    return INFOBOX_EXECUTOR.submit(_fetch_infobox, key, fetcher, arg)
+
+# Returns whichever infobox arrives first before the deadline, skipping lookups that failed
+# and cancelling any that haven't started yet
+def _fastest_infobox(futures, deadline: float):
+    try:
+        for future in as_completed(futures, timeout=max(0, deadline - time.time())):
             try:
-                return {"infotype": "calc", "equ": equ, "result": str(eval(equ))}
+                infobox = future.result()
             except Exception:
-                return None
+                continue
+            if (infobox != None):
+                return infobox
+    except FutureTimeoutError:
+        return None
+    finally:
+        for future in futures:
+            future.cancel()
+    return None
+
+def get_infobox(web_results, query):
+    # Check if the user is trying to get a maths equation done
+    calc = _solve_math(query)
+    if (calc != None):
+        return calc
+    # The Wiktionary and Wikipedia lookups are all network bound, so fire them at once
+    # rather than waiting on each one in turn
+    definition_future = None
+    wiki_futures = []
+    # The pool is shared with every other search, so only wait so long for it
+    deadline = time.time() + REQUEST_TIMEOUT
     # Check if the user is checking the definition of a word
-    def_match0 = re.match(r'^what does ([a-zA-Z]+) mean$', query, re.IGNORECASE)
-    def_match1 = re.match(r'^define ([a-zA-Z]+)$', query, re.IGNORECASE)
-    word = None
-    if (def_match0):
-        word = def_match0.group(1)
-    elif (def_match1):
-        word = def_match1.group(1)
-    if (word != None):
-        # it's a definition, return Wiktionary definition
-        url = "https://en.wiktionary.org/api/rest_v1/page/definition/" + word
-        response = requests.get(url, headers = WIKIPEDIA_API_HEADERS)
-        if response.status_code != 200:
-            return None
-        data = response.json()
-        definition = None
-        for d in data["en"][0]["definitions"]:
-            if d["definition"] != "":
-                definition = d["definition"]
-                break
-        return {"word": word,
-                "type": data["en"][0]["partOfSpeech"],
-                "definition": definition,
-                "url": "https://en.wiktionary.org/wiki/" + word,
-                "infotype": "definition"}
-    # If one of the first 3 results are a wikipedia article, return the first page of the article
-    for i in range(min(3, len(web_results))):
-        if "wikipedia.org" in web_results[i]["href"]:
-            formatted_title = web_results[i]["title"].split(" - Wikipedia")[0].replace(" ", "_")
-            url = "https://en.wikipedia.org/api/rest_v1/page/summary/" + formatted_title
-            response = requests.get(url, headers=WIKIPEDIA_API_HEADERS)
-            if response.status_code != 200:
-                return None
-            data = response.json()
-            return {"title": data["title"],
-                    "info": data["extract"],
-                    "url": data["content_urls"]["desktop"]["page"],
-                    "infotype": "wikipedia"}
-    return None # No infobox
+    def_match = DEFINITION_PATTERN.match(query)
+    if (def_match):
+        word = def_match.group(def_match.lastindex)
+        definition_future = _infobox_lookup(("definition", word), _get_definition, word)
+        # A cached definition wins outright, so don't go on to ask Wikipedia
+        if (definition_future.done() and definition_future.exception() == None and definition_future.result() != None):
+            return definition_future.result()
+    # If one of the first 3 results are a wikipedia article, use the first page of the article
+    for result in web_results[:3]:
+        wiki_match = WIKIPEDIA_URL_PATTERN.match(result.get("href", ""))
+        if (wiki_match):
+            wiki_futures.append(_infobox_lookup(("wikipedia", wiki_match.group(1)), _get_wikipedia_summary, wiki_match.group(1)))
+    # A definition still beats Wikipedia, but any Wikipedia article that answers will do
+    if (definition_future != None):
+        infobox = _fastest_infobox([definition_future], deadline)
+        if (infobox != None):
+            for future in wiki_futures:
+                future.cancel()
+            return infobox
+    return _fastest_infobox(wiki_futures, deadline) # None if no infobox
+
+# Serialises responses with orjson, which is much quicker than json on big result lists
+class OrjsonProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        # Keys that aren't strings are allowed, as they are by json, and dates are left to
+        # Flask's default so they still come out as HTTP dates
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if (kwargs.get("sort_keys", self.sort_keys)):
+            option |= orjson.OPT_SORT_KEYS
+        # orjson only indents by two, which is what Flask asks for in debug mode
+        if (kwargs.get("indent")):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=kwargs.get("default", self.default), option=option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+if (orjson != None):
+    app.json = OrjsonProvider(app)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
 @app.route("/api/search")
@@ -156,8 +440,10 @@ def results():
         language = "en-GB"
     videos = True if request.args.get("videos") == "true" else False
     page = request.args.get("page")
-    page = page if page != None else 0
-    if (query == None):
+    # Normalised to an int so the cache sees the same page however it was requested
+    page = int(page) if (page != None and page.isdigit()) else 0
+    # ddgs refuses a blank query, and that must not count against the backend
+    if (query == None or query.strip() == ""):
         return "noquery"
     if (safe_search == None):
         safe_search = "strict"
@@ -169,10 +455,12 @@ def results():
     else:
         infobox = None
     infobox = "null" if (infobox == None) else infobox
-    return {
+    response = {
         "infobox": infobox,
         "results": results,
     }
+    prefetch_next_page(query, safe_search, videos, page, language, backend, results)
+    return response
 
 @app.route("/api/images")
 def images():